@@ -26,12 +26,14 @@ For the full documentation, see https://github.com/hagai-helman/jsop.
 """
 
 import dbm
+import gc
 import io
 import json
+from collections import OrderedDict
 from warnings import warn
 
 FORMAT_NAME = "JSOP"
-FORMAT_VERSION_MAJOR = 1
+FORMAT_VERSION_MAJOR = 4
 FORMAT_VERSION_MINOR = 0
 
 #
@@ -80,50 +82,229 @@ FORMAT_VERSION_MINOR = 0
 
 
 
+# When the (optional) orjson package is installed, it is used for JSON
+# serialization; it is considerably faster than the standard library's json.
+# Note that both serializers produce and accept UTF-8 encoded byte-strings.
+
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    def json_dumps(value):
+        return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode("utf8")
+    json_loads = json.loads
+
 
 class DBMWrapper(object):
     """A wrapper for a DBM, with three features:
 
     * The keys are tuples of (unicode) strings (instead of bytearrays);
     * The values are any JSON-encodable object (instead of bytearrays);
-    * A cache is used to avoid unnecessary I/O operations.
+    * A cache is used to avoid unnecessary I/O operations. It holds at most
+      MAX_CACHE decoded values, evicting the least recently used one when it
+      is full. The key-encoding memos and the negative cache are likewise
+      capped (at MAX_KEY_MEMO and MAX_CACHE entries), and simply reset when
+      they overflow, so memory stays bounded no matter how much data is
+      touched.
+
+    Writes are buffered: they are accumulated in memory, and flushed to the
+    underlying DBM in one pass when the wrapper is closed (or when the buffer
+    grows beyond MAX_DIRTY pending entries). This way, a workload that touches
+    many keys pays for one bulk write instead of one DBM write per key.
 
     The usage is similar to a dbm object.
     """
+
+    MAX_DIRTY = 2 ** 16
+    MAX_CACHE = 2 ** 16
+    MAX_KEY_MEMO = 2 ** 13
+
     def __init__(self, *args):
         self._args = args
 
     def __enter__(self):
-        self._cache = {}
-        self._dbm = dbm.open(*self._args).__enter__()
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._deleted = set()
+        self._missing = set()
+        self._bkeys = {}
+        self._tkeys = {}
+        self._dbm = self._open()
         return self
 
+    def _open(self):
+        # When writing, try to append gdbm's "fast mode" modifier to the flag,
+        # which defers disk synchronization until the DBM is closed. Other
+        # backends reject the modifier; for them, open with the flag as-is.
+        (filename, flag) = (self._args[0], self._args[1])
+        if flag in ("w", "c", "n"):
+            try:
+                return dbm.open(filename, flag + "f", *self._args[2:]).__enter__()
+            except:
+                pass
+        return dbm.open(*self._args).__enter__()
+
+    def _encode(self, key):
+        """Encode a tuple-of-strings key to its DBM byte-string form.
+
+        Since the same key tuples are encoded over and over again (addresses
+        are immutable tuples, extended with '+'), the results are memoized.
+        """
+        bkey = self._bkeys.get(key)
+        if bkey is None:
+            bkey = b'\xff'.join([s.encode("utf8") for s in key])
+            self._memoize_key(key, bkey)
+        return bkey
+
+    def _memoize_key(self, key, bkey):
+        """Record a key encoding in both directions, keeping the memos bounded."""
+        if len(self._bkeys) >= self.MAX_KEY_MEMO:
+            self._bkeys.clear()
+            self._tkeys.clear()
+        self._bkeys[key] = bkey
+        self._tkeys[bkey] = key
+
+    def _note_missing(self, bkey):
+        """Record that a key is absent, keeping the negative cache bounded."""
+        if len(self._missing) >= self.MAX_CACHE:
+            self._missing.clear()
+        self._missing.add(bkey)
+
+    def _encode_value(self, value):
+        """Encode a value to its DBM byte-string form.
+
+        Numbers, booleans and null are stored with a one-byte type tag,
+        skipping the JSON encoder for the scalars that dominate many
+        workloads. Every other value is stored as 'j' followed by its
+        JSON serialization.
+        """
+        if value is True:
+            return b't'
+        if value is False:
+            return b'f'
+        if value is None:
+            return b'n'
+        if type(value) is int:
+            return b'i' + str(value).encode("ascii")
+        if type(value) is float:
+            return b'd' + repr(value).encode("ascii")
+        return b'j' + json_dumps(value)
+
+    def _decode_value(self, bvalue):
+        """Decode a byte-string stored in the DBM back to its value."""
+        tag = bvalue[:1]
+        if tag == b'j':
+            return json_loads(bvalue[1:])
+        if tag == b'i':
+            return int(bvalue[1:])
+        if tag == b'd':
+            return float(bvalue[1:])
+        if tag == b't':
+            return True
+        if tag == b'f':
+            return False
+        if tag == b'n':
+            return None
+        # No recognized tag: the value was written before the type tags
+        # were introduced (format 1.x), and is raw JSON. Decoding it keeps
+        # the metadata of old files readable, so opening one reports its
+        # format version instead of crashing.
+        return json_loads(bvalue)
+
+    def _cache_put(self, key, value):
+        """Cache a decoded value, evicting the least recently used entry if needed."""
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.MAX_CACHE:
+            self._cache.popitem(last = False)
+
     def __exit__(self, *args):
-        self._dbm.__exit__(*args)
-    
+        try:
+            self._flush()
+        finally:
+            self._dbm.__exit__(*args)
+
+    def _flush(self):
+        """Write all pending changes to the underlying DBM."""
+        for bkey in self._deleted:
+            del self._dbm[bkey]
+        self._deleted.clear()
+        for (bkey, bvalue) in self._dirty.items():
+            self._dbm[bkey] = bvalue
+        self._dirty.clear()
+
     def __getitem__(self, key):
-        bkey = b'\xff'.join((s.encode("utf8") for s in key))
-        if bkey not in self._cache:
-            self._cache[key] = json.loads(self._dbm[bkey].decode("utf8"))
+        if key in self._cache:
+            self._cache.move_to_end(key)
+        else:
+            bkey = self._encode(key)
+            if bkey in self._dirty:
+                self._cache_put(key, self._decode_value(self._dirty[bkey]))
+            elif bkey in self._deleted or bkey in self._missing:
+                raise KeyError(key)
+            else:
+                self._cache_put(key, self._decode_value(self._dbm[bkey]))
         return self._cache[key]
 
     def __setitem__(self, key, value):
-        bkey = b'\xff'.join((s.encode("utf8") for s in key))
-        bvalue = json.dumps(value).encode("utf8")
-        self._dbm[bkey] = bvalue
-        self._cache[key] = value
+        bkey = self._encode(key)
+        bvalue = self._encode_value(value)
+        self._deleted.discard(bkey)
+        self._missing.discard(bkey)
+        self._dirty[bkey] = bvalue
+        self._cache_put(key, value)
+        if len(self._dirty) >= self.MAX_DIRTY:
+            self._flush()
 
     def __delitem__(self, key):
-        bkey = b'\xff'.join((s.encode("utf8") for s in key))
-        del self._dbm[bkey]
-        del self._cache[key]
+        bkey = self._encode(key)
+        if bkey in self._dirty:
+            del self._dirty[bkey]
+            if bkey in self._dbm:
+                self._deleted.add(bkey)
+        elif bkey not in self._deleted and bkey in self._dbm:
+            self._deleted.add(bkey)
+        else:
+            raise KeyError(key)
+        self._note_missing(bkey)
+        self._cache.pop(key, None)
 
     def __contains__(self, key):
-        bkey = b'\xff'.join((s.encode("utf8") for s in key))
-        return bkey in self._dbm
+        if key in self._cache:
+            return True
+        bkey = self._encode(key)
+        if bkey in self._dirty:
+            return True
+        if bkey in self._deleted or bkey in self._missing:
+            return False
+        if bkey in self._dbm:
+            return True
+        self._note_missing(bkey)
+        return False
 
     def keys(self):
-        return [tuple([s.decode("utf8") for s in bkey.split(b'\xff')]) for bkey in self._dbm.keys()]
+        # Decoded keys are memoized (in both directions), so a key is only
+        # ever split and UTF-8 decoded once per session. Note that the empty
+        # tuple (the root address) is encoded to an empty byte-string, which
+        # must not be decoded to a 1-tuple of an empty string.
+        result = []
+        for bkey in (set(self._dbm.keys()) | set(self._dirty)) - self._deleted:
+            key = self._tkeys.get(bkey)
+            if key is None:
+                key = tuple([s.decode("utf8") for s in bkey.split(b'\xff')]) if bkey else ()
+                self._memoize_key(key, bkey)
+            result.append(key)
+        return result
+
+    def scan(self, prefix):
+        """Iterate over all (key, value) pairs whose key extends the given tuple.
+
+        The candidate keys are listed with a single pass over the underlying
+        DBM, instead of one DBM lookup per key of interest.
+        """
+        n = len(prefix)
+        for key in self.keys():
+            if key[:n] == prefix:
+                yield (key, self[key])
 
 
 class ReadOnlyDBMWrapper(DBMWrapper):
@@ -173,6 +354,12 @@ class JObject(object):
         else:
             return self.export() == other
 
+def is_primitive(value):
+    """Return whether a value is stored directly at its address
+    (i.e., it is neither a map nor a list)."""
+    return not (isinstance(value, dict) or isinstance(value, list)
+                or isinstance(value, tuple) or isinstance(value, JObject))
+
 def referror(ref):
     return JSOPError("Invalid Reference: " + "".join(["[{}]".format(repr(index)) for index in ref[1::3]]))
 
@@ -191,26 +378,60 @@ class JData(object):
     2. If the user tried to delete or override a map or a list, it first destroys
        it, to ensure that all garbage in the database will be collected.
     """
+    MAX_JOBJECTS = 2 ** 13
+
     def __init__(self, db):
         self._db = db
+        self._jobjects = {}
 
     def __getitem__(self, address):
+        jobject = self._jobjects.get(address)
+        if jobject is not None:
+            return jobject
         try:
             value = self._db[address]
         except:
             raise referror(address)
         if isinstance(value, dict):
-            return JDict(self, address)
+            jobject = JDict(self, address)
         elif isinstance(value, list):
-            return JList(self, address)
+            jobject = JList(self, address)
         else:
             return value
+        # The wrapper memo is just a cache; resetting it when it overflows
+        # keeps memory bounded, at the cost of re-wrapping on later access.
+        if len(self._jobjects) >= self.MAX_JOBJECTS:
+            self._jobjects.clear()
+        self._jobjects[address] = jobject
+        return jobject
+
+    def _forget(self, address):
+        """Drop the memoized wrappers of an address and of everything under it."""
+        n = len(address)
+        for addr in [addr for addr in self._jobjects if addr[:n] == address]:
+            del self._jobjects[addr]
 
     def __setitem__(self, address, value):
         if isinstance(value, JObject):
             value = value.export()
         if address in self._db:
+            if is_primitive(value) and is_primitive(self._db[address]):
+                # A primitive overwriting a primitive needs no destruction;
+                # the new value simply replaces the old one.
+                self._db[address] = value
+                return
             del self[address]
+        self._setnew(address, value)
+
+    def _setnew(self, address, value):
+        """Store a value at an address known to be vacant.
+
+        Unlike __setitem__, this skips the existence probe and the destruction
+        of a previous value, which initialization of a fresh subtree never
+        needs.
+        """
+        if isinstance(value, JObject):
+            value = value.export()
         if isinstance(value, dict):
             self._db[address] = {}
             new_dict = JDict(self, address)
@@ -225,6 +446,7 @@ class JData(object):
     def __delitem__(self, address):
         if address in self._db and isinstance(self[address], JObject):
             self[address]._destroy()
+        self._forget(address)
         try:
             del self._db[address]
         except:
@@ -233,70 +455,139 @@ class JData(object):
     def __contains__(self, address):
         return address in self._db
 
+    def export(self, address):
+        """Export the object at the given address as a Python native object.
+
+        A root export fetches the whole file with a single scan of the DBM,
+        instead of one DBM lookup per key. For any other address, a scan
+        would enumerate every key in the file just to find the subtree's,
+        so the subtree is walked through its key lists instead, touching
+        only its own addresses.
+        """
+        if len(address) == 0:
+            flat = dict(self._db.scan(address))
+            return self._assemble(flat, address)
+        try:
+            return self._assemble(self._db, address)
+        except KeyError:
+            raise referror(address)
+
+    def _assemble(self, flat, address):
+        # 'flat' only needs subscripting by address, so it may be either a
+        # pre-scanned {address: value} dict or the DBMWrapper itself.
+        value = flat[address]
+        if not (isinstance(value, dict) or isinstance(value, list)):
+            return value
+        # The subtree is assembled iteratively, with an explicit stack of
+        # (container, address) pairs, so deeply nested data neither pays for a
+        # Python frame per level nor hits the recursion limit.
+        result = {} if isinstance(value, dict) else []
+        stack = [(result, address)]
+        while len(stack) > 0:
+            (container, addr) = stack.pop()
+            addr_k = addr + ('k',)
+            for key in flat[addr + ('keys',)]:
+                vaddr = addr_k + (key, 'v')
+                item = flat[vaddr]
+                if isinstance(item, dict):
+                    item = {}
+                    stack.append((item, vaddr))
+                elif isinstance(item, list):
+                    item = []
+                    stack.append((item, vaddr))
+                if isinstance(container, dict):
+                    container[key] = item
+                else:
+                    container.append(item)
+        return result
+
+
+class JDict(JObject):
+    MAX_VADDRS = 2 ** 13
 
-class JDict(JObject): 
     def __init__(self, db, address):
         self._db = db
         self._address = address
+        self._address_k = address + ('k',)
+        self._address_keys = address + ('keys',)
+        self._vaddrs = {}
+
+    def _vaddr(self, key):
+        """Return the address of the value stored under a key.
+
+        The address tuples are pooled, so repeated accesses to the same key
+        reuse one tuple (and its memoized byte encoding) instead of building
+        a new one per operation.
+        """
+        addr = self._vaddrs.get(key)
+        if addr is None:
+            addr = self._address_k + (key, 'v')
+            if len(self._vaddrs) >= self.MAX_VADDRS:
+                self._vaddrs.clear()
+            self._vaddrs[key] = addr
+        return addr
+
+    def _keys(self):
+        """Return the insertion-ordered key list, as stored in the DBM.
+
+        The key list is stored as a plain JSON list, so it is read and
+        written through the underlying DBMWrapper (going through JData
+        would wrap it with a JObject).
+        """
+        try:
+            return self._db._db[self._address_keys]
+        except KeyError:
+            raise referror(self._address)
+
+    def _store_keys(self, keys):
+        self._db._db[self._address_keys] = keys
 
     def _init(self, value):
         """See JObject._init() for details."""
-        self._db[self._address + ('p',)] = None
-        self._db[self._address + ('n',)] = None
-        self._db[self._address + ('s',)] = 0
+        items = {}
         for key in value:
-            self[key] = value[key]
+            items[str(key)] = value[key]
+        self._store_keys(list(items))
+        if all(is_primitive(item) for item in items.values()):
+            # Homogeneous-scalar map: write the values straight to the DBM,
+            # without per-value type dispatch.
+            db = self._db._db
+            for (key, item) in items.items():
+                db[self._vaddr(key)] = item
+        else:
+            for (key, item) in items.items():
+                self._db._setnew(self._vaddr(key), item)
 
     def __getitem__(self, key):
         key = str(key)
-        return self._db[self._address + ('k', key, 'v')]
+        return self._db[self._vaddr(key)]
 
     def __setitem__(self, key, value):
         key = str(key)
         if key not in self:
-            last_key = self._db[self._address + ('p',)]
-            self._db[self._address + ('k', key, 'p')] = last_key
-            self._db[self._address + ('k', key, 'n')] = None
-            if last_key is not None:
-                self._db[self._address + ('k', last_key, 'n')] = key
-            else:
-                self._db[self._address + ('n',)] = key
-            self._db[self._address + ('p',)] = key
-            self._db[self._address + ('s',)] += 1
-        self._db[self._address + ('k', key, 'v')] = value
+            keys = self._keys()
+            keys.append(key)
+            self._store_keys(keys)
+        self._db[self._vaddr(key)] = value
 
     def __delitem__(self, key):
         if key not in self:
             raise KeyError(repr(key))
         key = str(key)
-        prev_key = self._db[self._address + ('k', key, 'p')]
-        next_key = self._db[self._address + ('k', key, 'n')]
-        del self._db[self._address + ('k', key, 'v')]
-        del self._db[self._address + ('k', key, 'p')]
-        del self._db[self._address + ('k', key, 'n')]
-        if prev_key is not None:
-            self._db[self._address + ('k', prev_key, 'n')] = next_key
-        else:
-            self._db[self._address + ('n',)] = next_key
-        if next_key is not None:
-            self._db[self._address + ('k', next_key, 'p')] = prev_key
-        else:
-            self._db[self._address + ('p',)] = prev_key
-        self._db[self._address + ('s',)] -= 1
+        del self._db[self._vaddr(key)]
+        keys = self._keys()
+        keys.remove(key)
+        self._store_keys(keys)
 
     def __contains__(self, key):
         key = str(key)
-        return self._address + ('k', key, 'v') in self._db
+        return self._vaddr(key) in self._db
 
     def __iter__(self):
-        key = self._db[self._address + ('n',)]
-        while key is not None:
-            next_key = self._db[self._address + ('k', key, 'n')]
-            yield key
-            key = next_key
+        return iter(list(self._keys()))
 
     def __len__(self):
-        return self._db[self._address + ('s',)]
+        return len(self._keys())
 
     def keys(self):
         return list(self)
@@ -306,15 +597,28 @@ class JDict(JObject):
             del self[key]
 
     def update(self, other = None, **kw):
+        items = []
         if other is not None:
             if hasattr(other, "keys"):
-                for k in other.keys():
-                    self[k] = other[k]
+                items = [(str(k), other[k]) for k in other.keys()]
             else:
-                for (k, v) in other:
-                    self[k] = v
-        if len(kw) > 0:
-            self.update(kw)
+                items = [(str(k), v) for (k, v) in other]
+        items += [(k, v) for (k, v) in kw.items()]
+        self._update(items)
+
+    def _update(self, items):
+        """Store a batch of (key, value) pairs, updating the key list once."""
+        if len(items) == 0:
+            return
+        keys = self._keys()
+        existing = set(keys)
+        for (key, value) in items:
+            if key not in existing:
+                keys.append(key)
+                existing.add(key)
+        self._store_keys(keys)
+        for (key, value) in items:
+            self._db[self._vaddr(key)] = value
 
     def get(self, key, default=None):
         key = str(key)
@@ -364,57 +668,74 @@ class JDict(JObject):
 
     def export(self):
         """See JObject.export() for details."""
-        result = {}
-        for key in self:
-            if isinstance(self[key], JObject):
-                result[key] = self[key].export()
-            else:
-                result[key] = self[key]
-        return result
+        return self._db.export(self._address)
 
     def _destroy(self):
         """See JObject._destroy() for details."""
         self.clear()
-        del self._db[self._address + ('n',)]
-        del self._db[self._address + ('p',)]
-        del self._db[self._address + ('s',)]
+        del self._db._db[self._address_keys]
         
 
 
 class JList(JObject):
+    """A JSON-style list, stored as a map with stable item keys.
+
+    Every item gets a key allocated from a per-list counter (stored at the
+    list's 'c' address), and the map's key list holds the item keys in list
+    order. This way, an index lookup is a read of the key list, and removing
+    or inserting an item in the middle splices the key list instead of
+    shifting all the following values.
+    """
+    # Search methods export the whole list up to this size; beyond it, a
+    # one-shot export costs more than it saves, so they stream instead.
+    MAX_EXPORT_SEARCH = 256
+
     def __init__(self, db, address):
         self._dict = JDict(db, address)
+        self._db = db
+        self._address_c = address + ('c',)
+
+    def _next_key(self):
+        """Allocate a fresh item key from the persistent counter."""
+        try:
+            counter = self._db._db[self._address_c]
+        except KeyError:
+            raise referror(self._dict._address)
+        self._db._db[self._address_c] = counter + 1
+        return str(counter)
 
     def _init(self, value):
         """See JObject._init() for details."""
         self._dict._init({})
-        for item in value:
-            self.append(item)
+        self._db._db[self._address_c] = 0
+        self.extend(value)
 
     def __getitem__(self, index):
-        if index not in range(-len(self), len(self)):
+        n = len(self)
+        if index < -n or index >= n:
             raise IndexError("list index out of range")
-        elif index < 0:
-            return self[len(self) + index]
-        return self._dict[index]
+        if index < 0:
+            index += n
+        return self._dict[self._dict._keys()[index]]
 
     def __setitem__(self, index, value):
-        if index not in range(-len(self), len(self)):
+        n = len(self)
+        if index < -n or index >= n:
             raise IndexError("list assignment index out of range")
-        elif index < 0:
-            self[len(self) + index] = value
-        self._dict[index] = value
+        if index < 0:
+            index += n
+        self._dict[self._dict._keys()[index]] = value
 
     def __len__(self):
         return len(self._dict)
 
     def __iter__(self):
-        for i in range(len(self)):
-            yield self[i]
+        for key in list(self._dict._keys()):
+            yield self._dict[key]
 
     def __reversed__(self):
-        for i in range(len(self) - 1, -1, -1):
-            yield self[i]
+        for key in reversed(list(self._dict._keys())):
+            yield self._dict[key]
 
     def __add__(self, other):
         return list(self) + other
@@ -437,14 +758,19 @@ class JList(JObject):
         return self
 
     def __delitem__(self, index):
-        if index >= len(self) or index < -len(self):
+        n = len(self)
+        if index < -n or index >= n:
             raise IndexError("list assignment out of range")
-        elif index < 0:
-            del self[len(self) + index]
-        else:
-            for i in range(index, len(self) - 1):
-                self[i] = self[i + 1]
-            self.pop()
+        if index < 0:
+            index += n
+        # The index is known to be valid, so the item key is popped from
+        # the key list directly, skipping JDict's membership probe and
+        # its linear search for the key.
+        keys = self._dict._keys()
+        key = keys[index]
+        del self._db[self._dict._vaddr(key)]
+        keys.pop(index)
+        self._dict._store_keys(keys)
 
     def insert(self, index, value):
         if index >= len(self):
@@ -454,31 +780,42 @@ class JList(JObject):
         elif index < 0:
             self.insert(len(self) + index, value)
         else:
-            self.append(None)
-            for i in range(len(self) - 1, index, -1):
-                self[i] = self[i - 1]
-            self[index] = value
+            key = self._next_key()
+            keys = self._dict._keys()
+            keys.insert(index, key)
+            self._dict._store_keys(keys)
+            self._db[self._dict._vaddr(key)] = value
 
     def append(self, item):
-        self._dict[len(self)] = item
+        self._dict[self._next_key()] = item
 
     def pop(self):
         if len(self) == 0:
             raise IndexError("pop from empty list")
-        return self._dict.pop(len(self) - 1)
+        return self._dict.pop(self._dict._keys()[-1])
 
     def remove(self, item):
-        for i in range(len(self)):
-            if self[i] == item:
-                del self[i]
-                return
-        raise ValueError("item not in list")
+        if isinstance(item, JObject):
+            item = item.export()
+        if len(self) <= self.MAX_EXPORT_SEARCH:
+            try:
+                index = self.export().index(item)
+            except ValueError:
+                raise ValueError("item not in list")
+        else:
+            for (index, value) in enumerate(self):
+                if value == item:
+                    break
+            else:
+                raise ValueError("item not in list")
+        del self[index]
 
     def __contains__(self, item):
-        for i in range(len(self)):
-            if self[i] == item:
-                return True
-        return False
+        if isinstance(item, JObject):
+            item = item.export()
+        if len(self) <= self.MAX_EXPORT_SEARCH:
+            return item in self.export()
+        return any(value == item for value in self)
 
     def sort(self, *args, **kw):
         exported = self.export()
@@ -493,24 +830,56 @@ class JList(JObject):
         self.extend(exported)
 
     def index(self, value, start = 0, stop = 9223372036854775807):
-        for i in range(start, min(len(self), stop)):
-            if self[i] == value:
+        if isinstance(value, JObject):
+            value = value.export()
+        n = len(self)
+        if n <= self.MAX_EXPORT_SEARCH:
+            try:
+                return self.export().index(value, start, stop)
+            except ValueError:
+                raise ValueError("{} is not in list".format(value))
+        if start < 0:
+            start = max(n + start, 0)
+        if stop < 0:
+            stop += n
+        keys = self._dict._keys()
+        for i in range(start, min(stop, n)):
+            if self._dict[keys[i]] == value:
                 return i
         raise ValueError("{} is not in list".format(value))
 
     def count(self, value):
-        counter = 0
-        for item in self:
-            if item == value:
-                counter += 1
-        return counter
+        if isinstance(value, JObject):
+            value = value.export()
+        if len(self) <= self.MAX_EXPORT_SEARCH:
+            return self.export().count(value)
+        return sum(1 for item in self if item == value)
 
     def copy(self):
         return self.export()
 
     def extend(self, other):
-        for item in other:
-            self.append(item)
+        items = list(other)
+        if len(items) == 0:
+            return
+        try:
+            counter = self._db._db[self._address_c]
+        except KeyError:
+            raise referror(self._dict._address)
+        self._db._db[self._address_c] = counter + len(items)
+        new_keys = [str(counter + i) for i in range(len(items))]
+        keys = self._dict._keys()
+        keys.extend(new_keys)
+        self._dict._store_keys(keys)
+        if all(is_primitive(item) for item in items):
+            # Homogeneous-scalar batch: write the values straight to the DBM,
+            # without per-value type dispatch.
+            db = self._db._db
+            for (key, item) in zip(new_keys, items):
+                db[self._dict._vaddr(key)] = item
+        else:
+            for (key, item) in zip(new_keys, items):
+                self._db._setnew(self._dict._vaddr(key), item)
 
 
     def clear(self):
@@ -518,17 +887,12 @@ class JList(JObject):
 
     def export(self):
         """See JObject.export() for details."""
-        result = []
-        for item in self:
-            if isinstance(item, JObject):
-                result.append(item.export())
-            else:
-                result.append(item)
-        return result
+        return self._dict._db.export(self._dict._address)
 
     def _destroy(self):
         """See JObject._destroy() for details."""
         self._dict._destroy()
+        del self._db._db[self._address_c]
 
 
 
@@ -575,12 +939,23 @@ class JSOP(object):
         """Store a JSON-encodable object in a new JSOP file."""
         if self._readonly:
             raise io.UnsupportedOperation("not writable")
-        with DBMWrapper(self._filename, "n") as dbmw:
-            jdata = JData(dbmw)
-            jdata[("m", "format-name")] = FORMAT_NAME
-            jdata[("m", "format-version-major")] = FORMAT_VERSION_MAJOR
-            jdata[("m", "format-version-minor")] = FORMAT_VERSION_MINOR
-            jdata[()] = obj
+        # Bulk initialization allocates masses of short-lived tuples and
+        # byte-strings, and creates no reference cycles; pausing the cyclic
+        # garbage collector avoids repeated futile passes over them.
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            with DBMWrapper(self._filename, "n") as dbmw:
+                # The file was just created, so every address is known to be
+                # vacant, and the existence probe of a regular store is skipped.
+                jdata = JData(dbmw)
+                jdata._setnew(("m", "format-name"), FORMAT_NAME)
+                jdata._setnew(("m", "format-version-major"), FORMAT_VERSION_MAJOR)
+                jdata._setnew(("m", "format-version-minor"), FORMAT_VERSION_MINOR)
+                jdata._setnew((), obj)
+        finally:
+            if collecting:
+                gc.enable()
 
     def dump(self, obj = {}):
         """DEPRECATED. Synonym of init()."""
@@ -598,25 +973,30 @@ class JSOP(object):
         return self.export()
 
     def __enter__(self):
-        with DBMWrapper(self._filename, "r") as dbmw:
-            jdata = JData(dbmw)
+        # The format version is checked on the session's own DBMWrapper, so
+        # the file is opened only once per session.
+        if self._readonly:
+            self._dbmw = ReadOnlyDBMWrapper(self._filename, "r").__enter__()
+        else:
+            self._dbmw = DBMWrapper(self._filename, "w").__enter__()
+        try:
+            jdata = JData(self._dbmw)
             try:
                 format_name = jdata[("m", "format-name")]
                 format_version_major = jdata[("m", "format-version-major")]
                 format_version_minor = jdata[("m", "format-version-minor")]
             except:
                 raise JSOPError("Cannot determine fromat version")
-        supported_format = True
-        supported_format &= (format_name == FORMAT_NAME)
-        supported_format &= (format_version_major == FORMAT_VERSION_MAJOR)
-        supported_format &= (format_version_minor <= FORMAT_VERSION_MINOR)
-        if not supported_format:
-            raise JSOPError("Unsupported format version: {} {}.{}".format(format_name, format_version_major, format_version_minor))
-        if self._readonly:
-            self._dbmw = ReadOnlyDBMWrapper(self._filename, "r").__enter__()
-        else:
-            self._dbmw = DBMWrapper(self._filename, "w").__enter__()
-        return JData(self._dbmw)[()]
+            supported_format = True
+            supported_format &= (format_name == FORMAT_NAME)
+            supported_format &= (format_version_major == FORMAT_VERSION_MAJOR)
+            supported_format &= (format_version_minor <= FORMAT_VERSION_MINOR)
+            if not supported_format:
+                raise JSOPError("Unsupported format version: {} {}.{}".format(format_name, format_version_major, format_version_minor))
+            return jdata[()]
+        except:
+            self._dbmw.__exit__(None, None, None)
+            raise
 
     def __exit__(self, *args):
         self._dbmw.__exit__(*args)
@@ -648,13 +1028,20 @@ def print_usage():
     Else, the result will be (beautifully) printed to the standard output.
     """)
 
-if __name__ == "__main__":
+def main(argv = None):
+    """Run the CLI. Callable in-process, without spawning an interpreter.
+
+    ``argv`` are the arguments after the program name; defaults to
+    ``sys.argv[1:]``. Returns the intended exit status.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
     json_path : typing.Optional[str]
-    if 3 <= len(sys.argv) <= 4 and sys.argv[1] in ["init", "export"]:
-        command = sys.argv[1]
-        path = sys.argv[2]
-        if len(sys.argv) == 4:
-            json_path = sys.argv[3]
+    if 2 <= len(argv) <= 3 and argv[0] in ["init", "export"]:
+        command = argv[0]
+        path = argv[1]
+        if len(argv) == 3:
+            json_path = argv[2]
         else:
             json_path = None
 
@@ -666,12 +1053,23 @@ if __name__ == "__main__":
             JSOP(path).init(obj)
 
         elif command == "export":
+            # The result is written in chunks, as the encoder produces them,
+            # instead of materializing the whole JSON document as one string.
+            obj = JSOP(path, readonly=True).export()
             if json_path is None:
-                print(json.dumps(JSOP(path).export(), indent=1, sort_keys=True))
+                for chunk in json.JSONEncoder(indent=1, sort_keys=True).iterencode(obj):
+                    sys.stdout.write(chunk)
+                sys.stdout.write("\n")
             else:
-                json.dump(JSOP(path).export(), open(json_path, "w"), indent=0, sort_keys=True)
+                with open(json_path, "w") as json_file:
+                    for chunk in json.JSONEncoder(indent=0, sort_keys=True).iterencode(obj):
+                        json_file.write(chunk)
     else:
         print_usage()
-        exit(1)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
 
 
@@ -1,12 +1,23 @@
+import os
+from functools import lru_cache
+
 from setuptools import setup
 
+
+@lru_cache(maxsize=1)
+def long_description():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "README.md")
+    with open(path, "rb") as f:
+        return f.read().decode("utf-8")
+
+
 setup(
     name='jsop',
     version='1.3.1',
     author='Hagai Helman Tov',
     author_email='hagai.helman@gmail.com',
     description='Store big JSON-style files, but access the data quickly.',
-    long_description=open("README.md").read(),
+    long_description=long_description(),
     long_description_content_type="text/markdown",
     url='https://github.com/hagai-helman/jsop',
     keywords=['JSON', 'dbm', 'persistence'],